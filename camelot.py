@@ -1,54 +1,91 @@
 #!/usr/bin/env python3
+from collections import OrderedDict
+from collections.abc import Callable, Mapping
 from dataclasses import dataclass, field
+from types import MappingProxyType
 from typing import Any
-import json
+import asyncio
+import functools
+import hashlib
 import logging
-import sqlite3
+import operator
+import os
 import time
 
 from aiohttp import web
+from aiosqlitepool import SQLiteConnectionPool
 from openai import AsyncOpenAI, APIError
+import aiosqlite
+import orjson
+import uvloop
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 logger = logging.getLogger(__name__)
 
 
-def json_dumps(obj: Any) -> str:
-    return json.dumps(obj, separators=(",", ":"))
+# Coarse monotonic clock shared by the rate limiters, refreshed by tick() so the
+# streaming loop doesn't pay for a clock read on every token.
+CLOCK_INTERVAL = 0.1
+NOW = time.monotonic()
 
 
-@dataclass
+async def tick():
+    global NOW
+    while True:
+        NOW = time.monotonic()
+        await asyncio.sleep(CLOCK_INTERVAL)
+
+
+@dataclass(slots=True)
 class FakeModel:
     real_model: str
     system_prompt: str
+    system_message: Mapping[str, str] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        # Shared by every request for this model, so hand out a read-only view.
+        self.system_message = MappingProxyType(
+            {"role": "system", "content": self.system_prompt}
+        )
 
 
-@dataclass
+@dataclass(slots=True)
 class RateLimit:
     max_tokens: int = 50_000
     max_requests: int = 60
     tokens: float = field(init=False)
-    requests: int = field(init=False)
-    last_update: float = field(default_factory=time.time)
+    requests: float = field(init=False)
+    last_update: float = field(default_factory=time.monotonic)
+    _token_rate: float = field(init=False, repr=False)
+    _request_rate: float = field(init=False, repr=False)
+    _static_headers: dict[str, str] = field(init=False, repr=False)
+    _headers: Mapping[str, str] = field(init=False, repr=False)
+    _headers_state: tuple[int, int] | None = field(default=None, init=False, repr=False)
 
     def __post_init__(self):
         self.tokens = self.max_tokens
         self.requests = self.max_requests
+        self._token_rate = self.max_tokens / 3600  # Tokens per second
+        self._request_rate = self.max_requests / 60  # Requests per second
+        self._static_headers = {
+            "x-ratelimit-limit-requests": str(self.max_requests),
+            "x-ratelimit-limit-tokens": str(self.max_tokens),
+        }
 
     def update(self) -> None:
-        current_time = time.time()
+        current_time = NOW
         time_passed = current_time - self.last_update
-        tokens_to_add = time_passed * (self.max_tokens / 3600)  # Tokens per second
-
-        self.tokens = min(self.max_tokens, self.tokens + tokens_to_add)
+        if time_passed < 0.01:
+            return
+        self.tokens = min(self.max_tokens, self.tokens + time_passed * self._token_rate)
         self.requests = min(
-            self.max_requests, self.requests + int(time_passed / 60)
-        )  # Requests per minute
+            self.max_requests, self.requests + time_passed * self._request_rate
+        )
         self.last_update = current_time
 
     def check_and_update_request(self) -> bool:
         self.update()
-        if self.requests <= 0:
+        if self.requests < 1:
             return False
         self.requests -= 1
         return True
@@ -60,32 +97,62 @@ class RateLimit:
         self.tokens -= tokens
         return True
 
-    def is_rate_limited(self) -> bool:
+    def debit_tokens(self, tokens: int) -> None:
         self.update()
+        self.tokens -= tokens
+
+    # is_rate_limited and get_rate_limit_headers read the bucket as of the
+    # caller's last update() instead of refreshing it themselves.
+    def is_rate_limited(self) -> bool:
         return self.tokens <= 0 or self.requests <= 0
 
-    def get_rate_limit_headers(self) -> dict[str, str]:
-        self.update()
-        return {
-            "x-ratelimit-limit-requests": str(self.max_requests),
-            "x-ratelimit-limit-tokens": str(self.max_tokens),
-            "x-ratelimit-remaining-requests": str(self.requests),
-            "x-ratelimit-remaining-tokens": str(int(self.tokens)),
-            "x-ratelimit-reset-requests": f"{60 - int(time.time() - self.last_update) % 60}s",
-            "x-ratelimit-reset-tokens": f"{int(3600 - (time.time() - self.last_update))}s",
-        }
+    def get_rate_limit_headers(self) -> Mapping[str, str]:
+        # Only rebuild the header strings when the values they report change.
+        state = (int(self.requests), int(self.tokens))
+        if state != self._headers_state:
+            self._headers_state = state
+            self._headers = MappingProxyType(
+                {
+                    **self._static_headers,
+                    "x-ratelimit-remaining-requests": str(state[0]),
+                    "x-ratelimit-remaining-tokens": str(state[1]),
+                    "x-ratelimit-reset-requests": f"{60 - int(NOW - self.last_update) % 60}s",
+                    "x-ratelimit-reset-tokens": f"{int(3600 - (NOW - self.last_update))}s",
+                }
+            )
+        return self._headers
 
-    def log_token_usage(self, api_key: str, total_tokens: int, suffix: str = ""):
+    def log_token_usage(
+        self, api_key: str, total_tokens: int, generated: Mapping | None = None
+    ):
         self.update()
+        suffix = ""
+        if generated is not None and logger.isEnabledFor(logging.DEBUG):
+            suffix = f", generated {orjson.dumps(generated).decode()}"
         logger.info(
             f"{api_key} streamed {total_tokens} tokens, {int(self.tokens)}/{self.max_tokens} remaining{suffix}"
         )
 
 
-with open("api_key", "r") as file:
-    OPENAI_API_KEY = file.read().strip()
+TOKEN_DEBIT_BATCH = 16
+LOG_INTERVAL = 128  # tokens between progress logs; a power of two for the mask
+MAX_BODY_SIZE = 1024**2
 
-async_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+SSE_DONE = b"data: [DONE]\n\n"
+SSE_HEADERS = MappingProxyType(
+    {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "Connection": "keep-alive",
+    }
+)
+
+OPENAI_CLIENT = web.AppKey("openai_client", AsyncOpenAI)
+DB_POOL = web.AppKey("db_pool", SQLiteConnectionPool)
+SEEN_RESPONSES = web.AppKey("seen_responses", OrderedDict)
+WRITE_QUEUE = web.AppKey("write_queue", asyncio.Queue)
 
 FAKE_MODELS: dict[str, FakeModel] = {
     "galahad": FakeModel(
@@ -652,198 +719,455 @@ API_KEYS: dict[str, RateLimit] = {
     "sk-tea-taster": RateLimit(),
 }
 
-conn = sqlite3.connect("responses.db", check_same_thread=False, autocommit=True)
 
+async def connect_db() -> aiosqlite.Connection:
+    conn = await aiosqlite.connect(
+        "responses.db", isolation_level=None, cached_statements=256
+    )
+    await conn.executescript(
+        """PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-65536;"""
+    )
+    return conn
+
+
+MAX_SEEN_RESPONSES = 100_000
+
+WRITE_BATCH_SIZE = 128
+WRITE_BATCH_DELAY = 0.05  # seconds to wait for more rows before committing
+INSERT_RESPONSES = (
+    "INSERT OR IGNORE INTO responses (api_key, model, response_hash) VALUES (?, ?, ?)"
+)
+LOOKUP_BATCH_SIZE = 32
+SELECT_RESPONSES = (
+    "SELECT response_hash FROM responses WHERE api_key = ? AND model = ? "
+    f"AND response_hash IN ({', '.join('?' * LOOKUP_BATCH_SIZE)})"
+)
+
+
+def hash_message(conversation, message: dict[str, Any]):
+    conversation.update(orjson.dumps(message))
+    conversation.update(b",")
+
+
+# Streamed replies are hashed piece by piece without keeping the text around.
+# orjson escapes each character independently, so hashing START, each piece's
+# escaped content and END matches hash_message() on the finished message.
+ASSISTANT_MESSAGE_START = b'{"role":"assistant","content":"'
+ASSISTANT_MESSAGE_END = b'"},'
+
+
+def response_hash(conversation) -> bytes:
+    return conversation.digest()[:16]
+
+
+def remember_response(
+    seen_responses: OrderedDict[tuple[str, str, bytes], None],
+    key: tuple[str, str, bytes],
+):
+    seen_responses[key] = None
+    seen_responses.move_to_end(key)
+    if len(seen_responses) > MAX_SEEN_RESPONSES:
+        seen_responses.popitem(last=False)
 
-def add_response(api_key: str, model: str, response: str):
-    conn.execute(
-        "INSERT OR IGNORE INTO responses VALUES (?, ?, ?)", (api_key, model, response)
+
+async def openai_client(app: web.Application):
+    with open("api_key", "r") as file:
+        app[OPENAI_CLIENT] = AsyncOpenAI(api_key=file.read().strip())
+    yield
+    await app[OPENAI_CLIENT].close()
+
+
+async def clock(app: web.Application):
+    task = asyncio.create_task(tick())
+    yield
+    task.cancel()
+
+
+async def database(app: web.Application):
+    pool = SQLiteConnectionPool(connect_db, pool_size=2 * (os.cpu_count() or 1))
+    async with pool.connection() as conn:
+        await conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses
+                    (api_key TEXT, model TEXT, response_hash BLOB, PRIMARY KEY (api_key, model, response_hash))
+                    WITHOUT ROWID"""
+        )
+        cursor = await conn.execute("PRAGMA table_info(responses)")
+        columns = {row[1] for row in await cursor.fetchall()}
+    if "response_hash" not in columns:
+        await pool.close()
+        raise RuntimeError(
+            "responses.db uses the old (api_key, model, response) schema; "
+            "move it aside so a new database can be created"
+        )
+    app[DB_POOL] = pool
+    app[SEEN_RESPONSES] = OrderedDict()
+    yield
+    await pool.close()
+
+
+async def write_responses(
+    pool: SQLiteConnectionPool,
+    write_queue: asyncio.Queue[tuple[str, str, bytes] | None],
+):
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await write_queue.get()]
+        deadline = loop.time() + WRITE_BATCH_DELAY
+        while batch[-1] is not None and len(batch) < WRITE_BATCH_SIZE:
+            try:
+                batch.append(
+                    await asyncio.wait_for(write_queue.get(), deadline - loop.time())
+                )
+            except asyncio.TimeoutError:
+                break
+
+        stop = batch[-1] is None
+        if stop:
+            batch.pop()
+
+        if batch:
+            try:
+                async with pool.connection() as conn:
+                    await conn.execute("BEGIN IMMEDIATE")
+                    await conn.executemany(INSERT_RESPONSES, batch)
+                    await conn.execute("COMMIT")
+            except Exception:
+                logger.exception(f"Failed to store {len(batch)} responses")
+
+        if stop:
+            return
+
+
+async def response_writer(app: web.Application):
+    write_queue = app[WRITE_QUEUE] = asyncio.Queue()
+    task = asyncio.create_task(write_responses(app[DB_POOL], write_queue))
+    yield
+    write_queue.put_nowait(None)
+    await task
+
+
+def add_response(app: web.Application, api_key: str, model: str, response: bytes):
+    key = (api_key, model, response)
+    remember_response(app[SEEN_RESPONSES], key)
+    app[WRITE_QUEUE].put_nowait(key)
+
+
+async def check_responses(
+    app: web.Application, api_key: str, model: str, responses: list[bytes]
+) -> bool:
+    seen_responses = app[SEEN_RESPONSES]
+    missing = []
+    for response in responses:
+        key = (api_key, model, response)
+        if key in seen_responses:
+            seen_responses.move_to_end(key)
+        else:
+            missing.append(response)
+    if not missing:
+        return True
+
+    found = set()
+    async with app[DB_POOL].connection() as conn:
+        for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = missing[start : start + LOOKUP_BATCH_SIZE]
+            # Pad with repeats so every lookup reuses the same statement.
+            batch += batch[-1:] * (LOOKUP_BATCH_SIZE - len(batch))
+            cursor = await conn.execute(SELECT_RESPONSES, (api_key, model, *batch))
+            found.update(response for (response,) in await cursor.fetchall())
+            if not found.issuperset(batch):
+                return False
+    for response in found:
+        remember_response(seen_responses, (api_key, model, response))
+    return True
+
+
+@functools.lru_cache(maxsize=32)
+def error_body(message: str, error_type: str) -> bytes:
+    return orjson.dumps(
+        {"error": {"message": message, "type": error_type, "param": None, "code": None}}
     )
 
 
-def check_response(api_key: str, model: str, response: str) -> bool:
-    result = conn.execute(
-        "SELECT 1 FROM responses WHERE api_key = ? AND model = ? AND response = ?",
-        (api_key, model, response),
-    ).fetchone()
-    return result is not None
+def error_response(
+    message: str,
+    error_type: str,
+    status: int,
+    headers: Mapping[str, str] | None = None,
+) -> web.Response:
+    # aiohttp responses can't be reused, but the encoded body can.
+    return web.Response(
+        body=error_body(message, error_type),
+        status=status,
+        content_type="application/json",
+        headers=headers,
+    )
 
 
 async def proxy_completions(request: web.Request) -> web.Response:
     try:
-        api_key = request.headers.get("Authorization", "").split(" ")[-1]
-        if api_key not in API_KEYS:
+        api_key = request.headers.get("Authorization", "").rpartition(" ")[2]
+        rate_limit = API_KEYS.get(api_key)
+        if rate_limit is None:
             raise ValueError("Invalid API key")
+        if (request.content_length or 0) > MAX_BODY_SIZE:
+            raise web.HTTPRequestEntityTooLarge(MAX_BODY_SIZE, request.content_length)
 
-        body = await request.json()
+        body = orjson.loads(await request.read())
         model = body.get("model")
-        if not model or model not in FAKE_MODELS:
+        fake_model = FAKE_MODELS.get(model) if model else None
+        if fake_model is None:
             raise ValueError("Invalid or missing model")
 
         messages = body.get("messages", [])
         if not isinstance(messages, list):
             raise ValueError("Valid messages array is required")
 
-        fake_model = FAKE_MODELS[model]
-        response = []
+        conversation = hashlib.sha256()
+        responses = []
         for message in messages:
-            response.append(message)
-            if message["role"] == "assistant" and not check_response(
-                api_key, model, json_dumps(response)
-            ):
-                raise ValueError("Invalid message response (nice try)")
+            if not isinstance(message, dict):
+                raise ValueError("Each message must be an object")
+            role = message.get("role")
+            if not isinstance(role, str):
+                raise ValueError("Each message must have a role")
+            hash_message(conversation, message)
+            if role == "assistant":
+                responses.append(response_hash(conversation))
+        if not await check_responses(request.app, api_key, model, responses):
+            raise ValueError("Invalid message response (nice try)")
 
-        full_messages = [
-            {"role": "system", "content": fake_model.system_prompt}
-        ] + messages
+        full_messages = [fake_model.system_message, *messages]
 
-        response = await async_client.chat.completions.create(
+        response = await request.app[OPENAI_CLIENT].chat.completions.create(
             model=fake_model.real_model,  # "gpt-4o-mini"
             messages=full_messages,
             stream=True,
         )
 
         return await handle_response(
-            request, response, model, messages, api_key, body.get("stream", False)
+            request,
+            response,
+            model,
+            conversation,
+            api_key,
+            rate_limit,
+            body.get("stream", False),
         )
 
-    except json.JSONDecodeError:
+    except web.HTTPRequestEntityTooLarge:
+        logger.error(f"Request body too large for {api_key}")
+        return error_response("Request body too large", "invalid_request_error", 413)
+    except orjson.JSONDecodeError:
         logger.error(f"Invalid JSON received for {api_key}")
-        return web.json_response(
-            {
-                "error": {
-                    "message": "Invalid JSON",
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": None,
-                }
-            },
-            status=400,
-        )
+        return error_response("Invalid JSON", "invalid_request_error", 400)
     except ValueError as e:
         logger.error(f"ValueError for {api_key}: {str(e)}")
-        return web.json_response(
-            {
-                "error": {
-                    "message": str(e),
-                    "type": "invalid_request_error",
-                    "param": None,
-                    "code": None,
-                }
-            },
-            status=400,
-        )
+        return error_response(str(e), "invalid_request_error", 400)
     except APIError as e:
         logger.error(f"APIError for {api_key}: {str(e)}")
         return web.Response(text=str(e), status=e.status_code)
     except Exception as e:
         logger.exception(f"Unexpected error for {api_key}: {str(e)}")
-        return web.json_response(
-            {
-                "error": {
-                    "message": "An unexpected error occurred",
-                    "type": "internal_server_error",
-                    "param": None,
-                    "code": None,
-                }
-            },
-            status=500,
+        return error_response(
+            "An unexpected error occurred", "internal_server_error", 500
         )
 
 
+@functools.cache
+def field_getter(model_type: type, exclude: str) -> operator.attrgetter:
+    # Every declared field plus any extras, resolved once per model class.
+    names = [name for name in model_type.model_fields if name != exclude]
+    return operator.attrgetter(*names, "model_extra")
+
+
+def chunk_shape_getter(chunk) -> Callable[[Any], tuple]:
+    # Everything in a streamed chunk except the delta's content. Chunks with the
+    # same shape serialize identically apart from that one string.
+    choice = chunk.choices[0]
+    chunk_fields = field_getter(type(chunk), "choices")
+    choice_fields = field_getter(type(choice), "delta")
+    delta_fields = field_getter(type(choice.delta), "content")
+
+    def chunk_shape(chunk) -> tuple:
+        choice = chunk.choices[0]
+        return (
+            chunk_fields(chunk),
+            chunk.choices[1:],
+            choice_fields(choice),
+            delta_fields(choice.delta),
+        )
+
+    return chunk_shape
+
+
+def chunk_frame_template(chunk) -> tuple[bytes, bytes]:
+    data = chunk.model_dump()
+    data["choices"][0]["delta"]["content"] = "\0"
+    prefix, _, suffix = orjson.dumps(data).partition(b'"\\u0000"')
+    return SSE_PREFIX + prefix + b'"', b'"' + suffix + SSE_SUFFIX
+
+
+async def stream_completion(
+    response,
+    api_key: str,
+    rate_limit: RateLimit,
+    stream_response: web.StreamResponse,
+    conversation,
+) -> int:
+    conversation.update(ASSISTANT_MESSAGE_START)
+    token_count = 0
+    pending_tokens = 0  # debited from the bucket every TOKEN_DEBIT_BATCH tokens
+    finish_reason = "stop"
+    # SSE frame halves around the content string, cached from the first chunk.
+    chunk_shape = template_shape = frame_prefix = frame_suffix = None
+    # Bound once so the per-token loop avoids repeated attribute lookups.
+    dumps = orjson.dumps
+    update_hash = conversation.update
+    write = stream_response.write
+    try:
+        async for chunk in response:
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+
+            if rate_limit.tokens - pending_tokens < 1:
+                finish_reason = "length"
+                chunk.choices[0].finish_reason = "length"
+            else:
+                pending_tokens += 1
+                if pending_tokens == TOKEN_DEBIT_BATCH:
+                    rate_limit.debit_tokens(pending_tokens)
+                    pending_tokens = 0
+
+            escaped = dumps(content)[1:-1]
+            update_hash(escaped)
+
+            if template_shape is None:
+                chunk_shape = chunk_shape_getter(chunk)
+                template_shape = chunk_shape(chunk)
+                frame_prefix, frame_suffix = chunk_frame_template(chunk)
+            if chunk_shape(chunk) == template_shape:
+                frame = b"".join((frame_prefix, escaped, frame_suffix))
+            else:
+                frame = b"".join(
+                    (SSE_PREFIX, chunk.model_dump_json().encode(), SSE_SUFFIX)
+                )
+            await write(frame)
+
+            token_count += 1
+            if token_count & (LOG_INTERVAL - 1) == 0:
+                rate_limit.log_token_usage(api_key, token_count)
+
+            if finish_reason == "length":
+                break
+    finally:
+        # Also charge for tokens already sent if the client or upstream drops.
+        rate_limit.debit_tokens(pending_tokens)
+    conversation.update(ASSISTANT_MESSAGE_END)
+    return token_count
+
+
+async def buffer_completion(
+    response, api_key: str, rate_limit: RateLimit
+) -> tuple[bytearray, int, str]:
+    completion = bytearray()
+    token_count = 0
+    pending_tokens = 0  # debited from the bucket every TOKEN_DEBIT_BATCH tokens
+    finish_reason = "stop"
+    try:
+        async for chunk in response:
+            content = chunk.choices[0].delta.content
+            if not content:
+                continue
+
+            if rate_limit.tokens - pending_tokens < 1:
+                finish_reason = "length"
+            else:
+                pending_tokens += 1
+                if pending_tokens == TOKEN_DEBIT_BATCH:
+                    rate_limit.debit_tokens(pending_tokens)
+                    pending_tokens = 0
+
+            completion += content.encode()
+
+            token_count += 1
+            if token_count & (LOG_INTERVAL - 1) == 0:
+                rate_limit.log_token_usage(api_key, token_count)
+
+            if finish_reason == "length":
+                break
+    finally:
+        rate_limit.debit_tokens(pending_tokens)
+    return completion, token_count, finish_reason
+
+
 async def handle_response(
     request: web.Request,
     response,
     model: str,
-    messages: list[dict],
+    conversation,
     api_key: str,
+    rate_limit: RateLimit,
     is_stream: bool,
 ) -> web.Response:
-    rate_limit = API_KEYS[api_key]
+    rate_limit.update()
     headers = rate_limit.get_rate_limit_headers()
     if rate_limit.is_rate_limited():
-        return web.json_response(
-            {
-                "error": {
-                    "message": "Rate limit exceeded",
-                    "type": "rate_limit_error",
-                    "param": None,
-                    "code": None,
-                }
-            },
-            status=429,
-            headers=headers,
-        )
+        logger.warning(f"Rate limit exceeded for {api_key}")
+        return error_response("Rate limit exceeded", "rate_limit_error", 429, headers)
 
     if is_stream:
         stream_response = web.StreamResponse(
             status=200,
             reason="OK",
-            headers={
-                "Content-Type": "text/event-stream",
-                "Cache-Control": "no-cache",
-                "Connection": "keep-alive",
-                **headers,
-            },
+            headers={**SSE_HEADERS, **headers},
         )
         await stream_response.prepare(request)
+        token_count = await stream_completion(
+            response, api_key, rate_limit, stream_response, conversation
+        )
+        add_response(request.app, api_key, model, response_hash(conversation))
+        rate_limit.log_token_usage(api_key, token_count)
 
-    chunks = []
-    token_count = 0
-    finish_reason = "stop"
-    async for chunk in response:
-        chunk_data = chunk.model_dump()
-        if chunk.choices[0].delta.content:
-            if not rate_limit.check_and_update_tokens(1):
-                finish_reason = "length"
-                chunk_data["choices"][0]["finish_reason"] = "length"
-
-            chunks.append(chunk.choices[0].delta.content)
-            if is_stream:
-                await stream_response.write(
-                    f"data: {json_dumps(chunk_data)}\n\n".encode("utf-8")
-                )
-
-            token_count += 1
-            if token_count % 100 == 0:
-                rate_limit.log_token_usage(api_key, token_count)
+        await stream_response.write_eof(SSE_DONE)
+        return stream_response
 
-            if finish_reason == "length":
-                if is_stream:
-                    await stream_response.write(b"data: [DONE]\n\n")
-                break
+    completion, token_count, finish_reason = await buffer_completion(
+        response, api_key, rate_limit
+    )
+    complete_message = completion.decode()
+    message = {"role": "assistant", "content": complete_message}
+    hash_message(conversation, message)
+    add_response(request.app, api_key, model, response_hash(conversation))
 
-    complete_message = "".join(chunks)
-    messages.append({"role": "assistant", "content": complete_message})
-    add_response(api_key, model, json_dumps(messages))
+    rate_limit.log_token_usage(api_key, token_count, message)
 
-    rate_limit.log_token_usage(
-        api_key, token_count, f", generated {json_dumps(messages)}"
+    response_dict = {
+        "choices": [
+            {
+                "message": message,
+                "finish_reason": finish_reason,
+            }
+        ]
+    }
+    return web.Response(
+        body=orjson.dumps(response_dict),
+        content_type="application/json",
+        headers=headers,
     )
 
-    if is_stream:
-        if finish_reason != "length":
-            await stream_response.write(b"data: [DONE]\n\n")
-        await stream_response.write_eof()
-        return stream_response
-    else:
-        response_dict = {
-            "choices": [
-                {
-                    "message": {"role": "assistant", "content": complete_message},
-                    "finish_reason": finish_reason,
-                }
-            ]
-        }
-        return web.json_response(response_dict, headers=headers)
-
 
-app = web.Application()
+app = web.Application(client_max_size=MAX_BODY_SIZE)
 app.router.add_route("POST", "/v1/chat/completions", proxy_completions)
+app.cleanup_ctx.append(openai_client)
+app.cleanup_ctx.append(clock)
+app.cleanup_ctx.append(database)
+app.cleanup_ctx.append(response_writer)
 
 if __name__ == "__main__":
-    conn.execute(
-        """CREATE TABLE IF NOT EXISTS responses
-                    (api_key TEXT, model TEXT, response TEXT, PRIMARY KEY (api_key, model, response))"""
-    )
-    web.run_app(app, host="127.0.0.1", port=8080)
+    uvloop.install()
+    web.run_app(app, host="127.0.0.1", port=8080, access_log=None)